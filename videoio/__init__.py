@@ -2,3 +2,4 @@ __version__ = '0.3.0'
 from .video_rgb import videoread, videosave, VideoReader, VideoWriter
 from .video_uint16 import uint16read, uint16save, Uint16Reader, Uint16Writer
 from .info import read_video_params
+from .yuv import yuv420p_to_rgb, split_yuv420p
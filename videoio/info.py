@@ -1,32 +1,108 @@
 import os
 import ffmpeg
 import subprocess
-from typing import Dict, Union
+from functools import lru_cache
+from fractions import Fraction
+from typing import Dict, Tuple, Union, Optional
 from pathlib import Path
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 H264_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'veryslow']
+H264_PRESETS_SET = frozenset(H264_PRESETS)
+H264_HW_ENCODERS = {'nvenc': 'h264_nvenc', 'qsv': 'h264_qsv', 'vaapi': 'h264_vaapi'}
+PROBE_ENTRIES = "stream=codec_type,width,height,avg_frame_rate,nb_frames:stream_tags=rotate"
+PROBE_ENTRIES_COUNTED = "stream=codec_type,width,height,avg_frame_rate,nb_frames,nb_read_frames:stream_tags=rotate"
+
+
+@lru_cache(maxsize=128)
+def _probe_cached(path: str, mtime: int, size: int, count_frames: bool = False) -> Dict:
+    """
+    Run ffprobe on the file, caching the result.
+    Modification time and size are part of the cache key, so the cached entry is invalidated when the file changes.
+    Only the fields used by read_video_params are requested to keep ffprobe output (and its parsing) small.
+    If count_frames is True, ffprobe decodes the whole stream to count the frames
+    """
+    args = ["ffprobe", "-v", "error", "-print_format", "json", "-select_streams", "v"]
+    if count_frames:
+        args += ["-count_frames", "-show_entries", PROBE_ENTRIES_COUNTED]
+    else:
+        args += ["-show_entries", PROBE_ENTRIES]
+    p = subprocess.Popen(args + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise ffmpeg.Error("ffprobe", out, err)
+    return json_loads(out)
 
 
-def read_video_params(path: Union[str, Path], stream_number: int = 0) -> Dict:
+@lru_cache(maxsize=128)
+def _probe_pyav_cached(path: str, mtime: int, size: int) -> Dict:
+    """
+    Same as _probe_cached, but reads the stream info in-process with PyAV instead of spawning ffprobe.
+    Output mimics the structure of ffprobe output
+    """
+    import av
+    streams = []
+    with av.open(path) as container:
+        for stream in container.streams.video:
+            stream_params = {'codec_type': 'video', 'width': stream.width, 'height': stream.height}
+            if stream.average_rate is not None:
+                stream_params['avg_frame_rate'] = '{}/{}'.format(stream.average_rate.numerator,
+                    stream.average_rate.denominator)
+            else:
+                stream_params['avg_frame_rate'] = '0/1'
+            if stream.frames > 0:
+                stream_params['nb_frames'] = str(stream.frames)
+            if 'rotate' in stream.metadata:
+                stream_params['tags'] = {'rotate': stream.metadata['rotate']}
+            streams.append(stream_params)
+    return {'streams': streams}
+
+
+@lru_cache(maxsize=None)
+def _is_pyav_available() -> bool:
+    try:
+        import av
+    except ImportError:
+        return False
+    return True
+
+
+def read_video_params(path: Union[str, Path], stream_number: int = 0, use_pyav: bool = False,
+        count_frames: bool = False) -> Dict:
     """
     Read _resolution and frame rate of the video
     Args:
         path (str, Path): Path to input file
         stream_number (int): Stream number to extract video parameters from
+        use_pyav (bool): Whether to read the parameters in-process with PyAV (if installed) instead of spawning ffprobe.
+            Saves the process startup time when many short videos are processed
+        count_frames (bool): Whether to count the frames by decoding the whole stream with ffprobe.
+            Slow, but gives the exact number of frames (stored as 'exact_length') even if the container
+            has no or incorrect frame count in its header
     Returns:
-        dict: Dictionary with height, width and FPS of the video
+        dict: Dictionary with height, width and FPS of the video (both as a number and as an exact fraction)
     """
     path = str(path)
     if not os.path.isfile(path):
         raise FileNotFoundError("{} does not exist".format(path))
-    try:
-        probe = ffmpeg.probe(path)
-    except FileNotFoundError:
-        raise FileNotFoundError("ffprobe not found, please reinstall ffmpeg")
+    file_stat = os.stat(path)
+    if use_pyav and not count_frames and _is_pyav_available():
+        probe = _probe_pyav_cached(os.path.abspath(path), file_stat.st_mtime_ns, file_stat.st_size)
+    else:
+        try:
+            probe = _probe_cached(os.path.abspath(path), file_stat.st_mtime_ns, file_stat.st_size, count_frames)
+        except FileNotFoundError:
+            raise FileNotFoundError("ffprobe not found, please reinstall ffmpeg")
     video_streams = [s for s in probe['streams'] if s['codec_type'] == 'video']
     stream_params = video_streams[stream_number]
-    fps_splitted = [int(x) for x in stream_params['avg_frame_rate'].split('/')]
-    fps = fps_splitted[0] if fps_splitted[1] == 1 else fps_splitted[0] / float(fps_splitted[1])
+    fps_numerator, _, fps_denominator = stream_params['avg_frame_rate'].partition('/')
+    fps_numerator = int(fps_numerator)
+    fps_denominator = int(fps_denominator) if fps_denominator else 1
+    fps = fps_numerator if fps_denominator == 1 else fps_numerator / float(fps_denominator)
     width = stream_params['width']
     height = stream_params['height']
     if 'nb_frames' in stream_params:
@@ -41,22 +117,90 @@ def read_video_params(path: Union[str, Path], stream_number: int = 0) -> Dict:
         if rotation % 90 == 0 and rotation % 180 != 0:
             width = stream_params['height']
             height = stream_params['width']
-    params = {'width': width, 'height': height, 'fps': fps}
+    params = {'width': width, 'height': height, 'fps': fps,
+              'fps_fraction': Fraction(fps_numerator, fps_denominator)}
     if length is not None:
         params['length'] = length
+    if 'nb_read_frames' in stream_params:
+        try:
+            params['exact_length'] = int(stream_params['nb_read_frames'])
+        except ValueError:
+            pass
     return params
 
 
-def ensure_encoder_presence(codec="libx264"):
+@lru_cache(maxsize=None)
+def _list_encoders() -> str:
     try:
         p = subprocess.Popen(["ffprobe", "-encoders"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         encoders_list, err_stream = p.communicate()
     except FileNotFoundError:
         raise FileNotFoundError("ffprobe not found, please reinstall ffmpeg")
+    return encoders_list.decode("utf-8")
 
-    if codec not in encoders_list.decode("utf-8"):
+
+def get_seek_time(start_frame: int, video_params: Dict, output_fps: Optional[float] = None) -> float:
+    """
+    Compute the time to seek to in order to start reading from start_frame.
+    The middle point between start_frame and the previous frame is taken to be robust to timestamp rounding.
+    Exact fraction of the framerate is used, so the time is not shifted by floating-point errors
+    for rates like 30000/1001
+    Args:
+        start_frame (int): frame to start reading from
+        video_params (dict): video parameters returned by read_video_params
+        output_fps (float): output framerate, if the video is resampled
+    Returns:
+        float: seek time in seconds
+    """
+    if output_fps is not None:
+        return float((start_frame - Fraction(1, 2)) / Fraction(output_fps))
+    return float((start_frame - Fraction(1, 2)) / video_params['fps_fraction'])
+
+
+def ensure_encoder_presence(codec="libx264"):
+    if codec not in _list_encoders():
         err_message = f"Codec {codec} is not available in the installed ffmpeg version."
         if codec in ["libx264", "libx265"]:
             err_message += (f"Make sure ffmpeg is installed with --enable-{codec} \n"
                             f"HINT: For conda users, run `conda remove ffmpeg` and `conda install ffmpeg {codec[-4:]} -c conda-forge`")
         raise ValueError(err_message)
+
+
+@lru_cache(maxsize=None)
+def _list_hwaccels() -> Tuple[str, ...]:
+    try:
+        p = subprocess.Popen(["ffmpeg", "-hide_banner", "-hwaccels"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        hwaccels_list, err_stream = p.communicate()
+    except FileNotFoundError:
+        raise FileNotFoundError("ffmpeg not found, please reinstall ffmpeg")
+    # First line is the "Hardware acceleration methods:" header
+    return tuple(line.strip() for line in hwaccels_list.decode("utf-8").splitlines()[1:] if line.strip())
+
+
+@lru_cache(maxsize=None)
+def _list_options() -> frozenset:
+    try:
+        p = subprocess.Popen(["ffmpeg", "-hide_banner", "-h", "long"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        help_text, err_stream = p.communicate()
+    except FileNotFoundError:
+        raise FileNotFoundError("ffmpeg not found, please reinstall ffmpeg")
+    # Options are listed one per line, e.g. "-filter_complex_threads  number of threads for -filter_complex"
+    return frozenset(line.split()[0][1:] for line in help_text.decode("utf-8").splitlines() if line.startswith("-"))
+
+
+def is_option_supported(option: str) -> bool:
+    """
+    Check whether the installed ffmpeg version supports the command line option
+    Args:
+        option (str): option name without the leading dash, e.g. 'filter_complex_threads'
+    Returns:
+        bool: True if the option is supported
+    """
+    return option in _list_options()
+
+
+def ensure_hwaccel_presence(hwaccel: str):
+    available_hwaccels = _list_hwaccels()
+    if hwaccel not in available_hwaccels:
+        raise ValueError(f"Hardware acceleration method {hwaccel} is not available in the installed ffmpeg version, "
+                         f"available methods are {list(available_hwaccels)}")
@@ -0,0 +1,258 @@
+import os
+import sys
+import queue
+import threading
+import subprocess
+import numpy as np
+from typing import Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MIN_PIPE_BUFFER_SIZE = 1 << 20
+# Kernel-side pipe capacity, 1 MB is the largest size allowed for unprivileged users by default on Linux
+KERNEL_PIPE_SIZE = 1 << 20
+# Value of fcntl.F_SETPIPE_SZ, which is only exposed by Python 3.10+
+F_SETPIPE_SZ = 1031
+# ffmpeg's H.264 decoding and encoding scale poorly beyond this number of threads
+MAX_DEFAULT_THREADS = 8
+# Maximal number of buffers accepted by a single writev call, sysconf returns -1 if there is no fixed limit
+try:
+    MAX_WRITEV_BUFFERS = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    MAX_WRITEV_BUFFERS = -1
+if MAX_WRITEV_BUFFERS <= 0:
+    MAX_WRITEV_BUFFERS = 16
+
+
+def get_default_threads() -> int:
+    """
+    Default number of ffmpeg threads: number of CPU cores, but not more than MAX_DEFAULT_THREADS
+    """
+    return min(os.cpu_count() or 1, MAX_DEFAULT_THREADS)
+
+
+def set_pipe_size(pipe, size: int = KERNEL_PIPE_SIZE):
+    """
+    Enlarge the kernel-side pipe buffer (Linux only, no-op elsewhere).
+    Default 64 KB pipes make ffmpeg and Python switch back and forth dozens of times per HD frame
+    Args:
+        pipe: pipe to resize
+        size (int): requested capacity in bytes
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, size)
+    except OSError:
+        # Requested size exceeds /proc/sys/fs/pipe-max-size
+        pass
+
+
+def prefetch_file(path: str):
+    """
+    Ask the kernel to start reading the file into the page cache in the background (POSIX only, no-op elsewhere),
+    so ffmpeg's reads of a file that is going to be decoded completely do not wait for the disk
+    Args:
+        path (str): Path to the file
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        # Read-ahead hints like POSIX_FADV_SEQUENTIAL apply only to this descriptor, not to the one opened by ffmpeg,
+        # while pages loaded with POSIX_FADV_WILLNEED are shared through the page cache
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def run_async(stream_spec, pipe_stdin: bool = False, pipe_stdout: bool = False,
+        frame_size: int = 0, buffered: bool = True) -> subprocess.Popen:
+    """
+    Asynchronously run ffmpeg with enlarged pipe buffers
+    (ffmpeg-python's run_async does not expose Popen's bufsize, leaving the pipes with tiny default buffers)
+    Args:
+        stream_spec: ffmpeg-python output stream to run or already compiled command line (list of arguments)
+        pipe_stdin (bool): Whether to connect a pipe to the process stdin
+        pipe_stdout (bool): Whether to connect a pipe to the process stdout
+        frame_size (int): Size of a single raw frame in bytes, Python-side buffer is enlarged to fit at least one frame.
+            Ignored for unbuffered pipes
+        buffered (bool): Whether to wrap pipes in Python-side buffers.
+            Pipes that are only read with readinto_exact or written with write_buffers should be unbuffered,
+            as these functions bypass the buffer anyway
+    Returns:
+        subprocess.Popen: running ffmpeg process
+    """
+    stdin_stream = subprocess.PIPE if pipe_stdin else None
+    stdout_stream = subprocess.PIPE if pipe_stdout else None
+    bufsize = max(MIN_PIPE_BUFFER_SIZE, int(frame_size)) if buffered else 0
+    args = stream_spec if isinstance(stream_spec, list) else stream_spec.compile()
+    process = subprocess.Popen(args, stdin=stdin_stream, stdout=stdout_stream, bufsize=bufsize)
+    for pipe in (process.stdin, process.stdout):
+        if pipe is not None:
+            set_pipe_size(pipe)
+    return process
+
+
+def readinto_exact(stream, buffer) -> int:
+    """
+    Fill the buffer with data from the pipe.
+    Reads from the underlying raw stream to skip the extra copy through BufferedReader's internal buffer,
+    short reads are retried until the buffer is full or the stream ends
+    Args:
+        stream: binary pipe to read from
+        buffer: writable C-contiguous object supporting buffer protocol (e.g. NumPy array)
+    Returns:
+        int: number of bytes read, less than the buffer size only if the stream has ended
+    """
+    raw = getattr(stream, "raw", stream)
+    view = memoryview(buffer)
+    if view.nbytes == 0:
+        return 0
+    view = view.cast('B')
+    bytes_read = 0
+    while bytes_read < len(view):
+        chunk_size = raw.readinto(view[bytes_read:])
+        if not chunk_size:
+            break
+        bytes_read += chunk_size
+    return bytes_read
+
+
+def write_buffers(stream, buffers: Sequence) -> None:
+    """
+    Write C-contiguous buffers (e.g. NumPy arrays) to the pipe without copying them to bytes objects.
+    Uses a single scatter-gather os.writev call where available
+    Args:
+        stream: binary pipe to write to
+        buffers (Sequence): objects supporting buffer protocol
+    """
+    if not hasattr(os, "writev"):
+        for buffer in buffers:
+            view = memoryview(buffer)
+            if view.nbytes == 0:
+                continue
+            view = view.cast('B')
+            # Unbuffered pipes may accept only a part of the data
+            while len(view) > 0:
+                view = view[stream.write(view):]
+        return
+    stream.flush()
+    fd = stream.fileno()
+    views = [memoryview(buffer).cast('B') for buffer in buffers if memoryview(buffer).nbytes > 0]
+    view_ind = 0
+    while view_ind < len(views):
+        written = os.writev(fd, views[view_ind:view_ind + MAX_WRITEV_BUFFERS])
+        # Skip fully written buffers and retry with the remainder in case of a partial write
+        while view_ind < len(views) and written >= len(views[view_ind]):
+            written -= len(views[view_ind])
+            view_ind += 1
+        if view_ind < len(views):
+            views[view_ind] = views[view_ind][written:]
+
+
+class FramePrefetcher:
+    """
+    Reads raw frames from the pipe in a background thread, keeping a bounded number of frames ahead of the consumer.
+    Pipe reads release the GIL, so ffmpeg keeps decoding while the consumer processes previous frames
+    """
+
+    def __init__(self, stream, frame_shape: Tuple[int, ...], depth: int = 2, reuse_buffers: bool = False):
+        """
+        Args:
+            stream: binary pipe to read from
+            frame_shape (Tuple[int, ...]): shape of a single uint8 frame
+            depth (int): maximal number of frames read ahead
+            reuse_buffers (bool): Whether to read frames into a fixed pool of preallocated buffers.
+                If True, every frame obtained with get() should be returned to the pool with release() once consumed
+        """
+        self._stream = stream
+        self._frame_shape = frame_shape
+        self._frame_size = int(np.prod(frame_shape))
+        self._queue = queue.Queue(maxsize=depth)
+        if reuse_buffers:
+            # Enough buffers for the queued frames, the frame being read and the frame held by the consumer
+            self._free_buffers = queue.Queue()
+            for _ in range(depth + 2):
+                self._free_buffers.put(np.empty(frame_shape, dtype=np.uint8))
+        else:
+            self._free_buffers = None
+        self._stop_event = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get_free_buffer(self) -> Optional[np.ndarray]:
+        if self._free_buffers is None:
+            return np.empty(self._frame_shape, dtype=np.uint8)
+        while not self._stop_event.is_set():
+            try:
+                return self._free_buffers.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _read_loop(self):
+        try:
+            while not self._stop_event.is_set():
+                frame = self._get_free_buffer()
+                if frame is None:
+                    break
+                if readinto_exact(self._stream, frame) < self._frame_size:
+                    break
+                self._put(frame)
+        except (OSError, ValueError):
+            # Stream was closed from outside
+            pass
+        finally:
+            self._put(None)
+
+    def get(self) -> Optional[np.ndarray]:
+        """
+        Get next frame
+        Returns:
+            np.ndarray: next frame or None if the stream has ended
+        """
+        if self._finished:
+            return None
+        frame = self._queue.get()
+        if frame is None:
+            self._finished = True
+        return frame
+
+    def release(self, frame: np.ndarray):
+        """
+        Return a consumed frame to the buffer pool (no-op if buffers are not reused)
+        Args:
+            frame (np.ndarray): frame previously obtained with get()
+        """
+        if self._free_buffers is not None:
+            self._free_buffers.put(frame)
+
+    def close(self):
+        """
+        Stop the reading thread
+        """
+        self._stop_event.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
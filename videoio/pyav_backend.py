@@ -0,0 +1,130 @@
+from fractions import Fraction
+from typing import Tuple, Optional
+import numpy as np
+
+# Pixel formats which are stored by libav in a single plane and can be wrapped without copying
+PACKED_PIX_FMTS = {'rgb24': 3, 'bgr24': 3, 'gray': 1}
+
+
+def _import_av():
+    try:
+        import av
+    except ImportError:
+        raise ImportError("PyAV backend requires PyAV to be installed, run `pip install av`")
+    return av
+
+
+def _packed_frame_view(frame, frame_shape: Tuple[int, ...]) -> np.ndarray:
+    """
+    Wrap the plane of a packed frame as a NumPy array without copying.
+    Rows of libav frames are padded for alignment, so the result is a strided view which skips the padding
+    Args:
+        frame (av.VideoFrame): decoded frame in rgb24, bgr24 or gray format
+        frame_shape (Tuple[int, ...]): shape of the output frame
+    Returns:
+        np.ndarray: view of the frame data, valid as long as it is referenced
+    """
+    plane = frame.planes[0]
+    height, width = frame_shape[:2]
+    row_size = width * PACKED_PIX_FMTS[frame.format.name]
+    plane_data = np.frombuffer(plane, dtype=np.uint8)
+    return plane_data[:plane.line_size * height].reshape(height, plane.line_size)[:, :row_size].reshape(frame_shape)
+
+
+class PyAVReader:
+    """
+    In-process frame decoder based on PyAV
+    """
+
+    def __init__(self, path: str, stream_number: int, frame_shape: Tuple[int, ...], resolution: Tuple[int, int],
+            pix_fmt: str, start_time: Optional[float] = None, accurate_seek: bool = True, threads: int = 0):
+        """
+        Args:
+            path (str): Path to input video
+            stream_number (int): Number of the video stream to decode
+            frame_shape (Tuple[int, ...]): shape of the output frames
+            resolution (Tuple[int, int]): resolution of the output frames (width, height)
+            pix_fmt (str): Pixel format of the output frames
+            start_time (float): Time (in seconds) to start decoding from. If None, video is decoded from the start
+            accurate_seek (bool): Whether to drop the frames between the preceding keyframe and start_time
+            threads (int): Number of decoding threads, 0 for automatic selection
+        """
+        av = _import_av()
+        self.container = av.open(path)
+        self.stream = self.container.streams.video[stream_number]
+        self.stream.thread_type = 'AUTO'
+        self.stream.codec_context.thread_count = threads
+        self.frame_shape = frame_shape
+        self.width, self.height = int(resolution[0]), int(resolution[1])
+        self.pix_fmt = pix_fmt
+        self.start_time = start_time if accurate_seek else None
+        if start_time is not None:
+            self.container.seek(int(start_time / self.stream.time_base), stream=self.stream)
+        self._decoded_frames = self.container.decode(self.stream)
+
+    def read(self) -> Optional[np.ndarray]:
+        """
+        Decode next frame
+        Returns:
+            np.ndarray: decoded frame or None if the end of the video is reached.
+                Packed formats are returned as views of the decoded frame, which might be non-contiguous
+        """
+        for frame in self._decoded_frames:
+            if self.start_time is not None:
+                if frame.time is not None and frame.time < self.start_time:
+                    continue
+                self.start_time = None
+            frame = frame.reformat(width=self.width, height=self.height, format=self.pix_fmt)
+            if self.pix_fmt in PACKED_PIX_FMTS:
+                return _packed_frame_view(frame, self.frame_shape)
+            return frame.to_ndarray().reshape(self.frame_shape)
+        return None
+
+    def close(self):
+        self.container.close()
+
+
+class PyAVWriter:
+    """
+    In-process H.264 encoder based on PyAV
+    """
+
+    def __init__(self, path: str, resolution: Tuple[int, int], lossless: bool, preset: str, fps: Optional[float],
+            threads: int):
+        """
+        Args:
+            path (str): Path to output video
+            resolution (Tuple[int, int]): Resolution of the input frames and output video (width, height)
+            lossless (bool): Whether to apply lossless encoding
+            preset (str): H.264 compression preset
+            fps (float): Target FPS. If None, 25 FPS is used (same as ffmpeg's default)
+            threads (int): Number of encoding threads
+        """
+        av = _import_av()
+        self._av = av
+        self.container = av.open(path, mode='w')
+        rate = Fraction(fps).limit_denominator(1 << 16) if fps is not None else 25
+        self.stream = self.container.add_stream('libx264', rate=rate)
+        self.stream.width, self.stream.height = int(resolution[0]), int(resolution[1])
+        self.stream.pix_fmt = 'yuv444p' if lossless else 'yuv420p'
+        self.stream.codec_context.thread_count = threads
+        options = {'preset': preset}
+        if lossless:
+            options['profile'] = 'high444'
+            options['crf'] = '0'
+        self.stream.options = options
+
+    def write(self, color_frame: np.ndarray):
+        """
+        Encode next frame
+        Args:
+            color_frame (np.ndarray): uint8 RGB frame
+        """
+        frame = self._av.VideoFrame.from_ndarray(color_frame, format='rgb24')
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+
+    def close(self):
+        for packet in self.stream.encode():
+            self.container.mux(packet)
+        self.container.close()
@@ -3,14 +3,121 @@ import numpy as np
 import ffmpeg
 import warnings
 from pathlib import Path
-from typing import Tuple, Dict, Union, Optional
-from .info import read_video_params, H264_PRESETS, ensure_encoder_presence
+from typing import Tuple, Dict, Union, Optional, List
+from .info import read_video_params, get_seek_time, H264_PRESETS, H264_PRESETS_SET, H264_HW_ENCODERS, \
+    ensure_encoder_presence, ensure_hwaccel_presence, is_option_supported
+from .pipes import run_async, readinto_exact, write_buffers, get_default_threads, prefetch_file, FramePrefetcher
+from .pyav_backend import PyAVReader, PyAVWriter
+
+RAW_INPUT_PARAMS = dict(format='rawvideo', pix_fmt='rgb24', loglevel='quiet')
+# Initial buffer size of videoread for videos with unknown number of frames
+MIN_READ_BUFFER_FRAMES = 16
+# Number of values converted from float to uint8 at once in videosave
+FLOAT_CONVERSION_CHUNK_SIZE = 1 << 24
+# Shapes of raw frames for the supported output pixel formats, as functions of (width, height)
+OUTPUT_FRAME_SHAPES = {
+    'rgb24': lambda width, height: (height, width, 3),
+    'bgr24': lambda width, height: (height, width, 3),
+    'gray': lambda width, height: (height, width),
+    'yuv420p': lambda width, height: (height * 3 // 2, width),
+    'nv12': lambda width, height: (height * 3 // 2, width),
+}
+# libx264 presets mapped to the closest NVENC (p1 - fastest, p7 - slowest) and QSV presets
+NVENC_PRESETS = {'ultrafast': 'p1', 'superfast': 'p1', 'veryfast': 'p2', 'faster': 'p3', 'fast': 'p4',
+                 'medium': 'p5', 'slow': 'p6', 'veryslow': 'p7'}
+QSV_PRESETS = {'ultrafast': 'veryfast', 'superfast': 'veryfast', 'veryfast': 'veryfast', 'faster': 'faster',
+               'fast': 'fast', 'medium': 'medium', 'slow': 'slow', 'veryslow': 'veryslow'}
+# Render node used by the VA-API encoder, can be overridden with VIDEOIO_VAAPI_DEVICE environment variable
+VAAPI_DEVICE = '/dev/dri/renderD128'
+BACKENDS = ['ffmpeg', 'pyav']
+# Values of ffmpeg's -vsync option for the supported frame synchronization modes
+FRAME_SYNC_MODES = {'passthrough': '0', 'cfr': '1', 'vfr': '2', 'drop': 'drop'}
+
+
+def _get_frame_shape(resolution: Tuple[int, int], pix_fmt: str) -> Tuple[int, ...]:
+    assert pix_fmt in OUTPUT_FRAME_SHAPES, "Pixel format '{}' is not supported, supported formats are {}". \
+        format(pix_fmt, list(OUTPUT_FRAME_SHAPES))
+    width, height = int(resolution[0]), int(resolution[1])
+    if pix_fmt in ('yuv420p', 'nv12'):
+        assert width % 2 == 0 and height % 2 == 0, "Pixel format {} requires even resolution".format(pix_fmt)
+    return OUTPUT_FRAME_SHAPES[pix_fmt](width, height)
+
+
+def _float_to_uint8(frame: np.ndarray, scratch: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Convert float frame in [0, 1] range to uint8 without allocating intermediate arrays
+    Args:
+        frame (np.ndarray): float frame to convert
+        scratch (np.ndarray): float32 buffer of the same shape used for intermediate values
+        out (np.ndarray): uint8 buffer of the same shape to store the result in
+    Returns:
+        np.ndarray: out buffer
+    """
+    # Multiplication is done in float32 for all float inputs, float16 arithmetic is too coarse for correct rounding
+    np.multiply(frame, np.float32(255.), out=scratch, dtype=np.float32, casting='unsafe')
+    np.rint(scratch, out=scratch)
+    np.clip(scratch, 0, 255, out=scratch)
+    np.copyto(out, scratch, casting='unsafe')
+    return out
+
+
+def _encoder_output(input_params: Dict, path: str, lossless: bool, preset: str, threads: Optional[int],
+        hwaccel: Optional[str], output_params: Optional[Dict] = None):
+    """
+    Create ffmpeg output for H.264 encoding with libx264 or a hardware encoder
+    Args:
+        input_params (dict): Parameters of ffmpeg input with raw frames
+        path (str): Path to output video
+        lossless (bool): Whether to apply lossless encoding
+        preset (str): libx264 compression preset, mapped to the closest preset of the hardware encoder
+        threads (int): Number of threads used by ffmpeg. If None, default number of threads is used
+        hwaccel (str): Hardware encoder to use ('nvenc', 'qsv' or 'vaapi'). If None, libx264 is used.
+            VA-API encoder uses the render node from VIDEOIO_VAAPI_DEVICE environment variable
+            (/dev/dri/renderD128 by default)
+        output_params (dict): Additional parameters of ffmpeg output (e.g. muxer options)
+    Returns:
+        ffmpeg output stream
+    """
+    assert preset in H264_PRESETS_SET, "Preset '{}' is not supported by libx264, supported presets are {}". \
+        format(preset, H264_PRESETS)
+    assert hwaccel is None or hwaccel in H264_HW_ENCODERS, \
+        "Hardware encoder '{}' is not supported, supported encoders are {}".format(hwaccel, list(H264_HW_ENCODERS))
+    codec = "libx264" if hwaccel is None else H264_HW_ENCODERS[hwaccel]
+    ensure_encoder_presence(codec)
+    encoding_params = {"c:v": codec, "threads": threads if threads is not None else get_default_threads()}
+    if output_params is not None:
+        encoding_params.update(output_params)
+    pix_fmt = 'yuv444p' if lossless else 'yuv420p'
+    if hwaccel is None:
+        encoding_params['preset'] = preset
+        if lossless:
+            encoding_params['profile:v'] = 'high444'
+            encoding_params['crf'] = 0
+    elif hwaccel == 'nvenc':
+        if lossless:
+            encoding_params['preset'] = 'lossless'
+            encoding_params['profile:v'] = 'high444p'
+        else:
+            encoding_params['preset'] = NVENC_PRESETS[preset]
+    else:
+        if lossless:
+            raise NotImplementedError("Lossless encoding is not supported by {}".format(codec))
+        pix_fmt = 'nv12'
+        if hwaccel == 'qsv':
+            encoding_params['preset'] = QSV_PRESETS[preset]
+    if hwaccel == 'vaapi':
+        # Frames are uploaded to the GPU memory before encoding
+        vaapi_device = os.environ.get('VIDEOIO_VAAPI_DEVICE', VAAPI_DEVICE)
+        ffmpeg_input = ffmpeg.input('pipe:', vaapi_device=vaapi_device, **input_params)
+        return ffmpeg_input.filter('format', pix_fmt).filter('hwupload').output(path, **encoding_params)
+    return ffmpeg.input('pipe:', **input_params).output(path, pix_fmt=pix_fmt, **encoding_params)
 
 
 def videoread(path: Union[str, Path], return_attributes: bool = False, stream_number: int = 0,
         output_resolution: Tuple[int, int] = None, output_fps: float = None, start_frame: int = 0,
-        respect_original_timestamps: bool = False) \
-        -> Union[np.ndarray, Tuple[np.ndarray, Dict]]:
+        respect_original_timestamps: bool = False, hwaccel: Optional[str] = None, num_frames: Optional[int] = None,
+        pix_fmt: str = 'rgb24', threads: Optional[int] = None, sws_flags: Optional[str] = None,
+        accurate_seek: bool = True, frame_sync: Optional[str] = None) -> Union[np.ndarray, Tuple[np.ndarray, Dict]]:
     """
     Reads an input video to a NumPy array
     Args:
@@ -27,6 +134,26 @@ def videoread(path: Union[str, Path], return_attributes: bool = False, stream_nu
         respect_original_timestamps (bool): whether to read frames according to timestamps or not
             If True, frames will be extracted according to framerate and video timestamps,
             otherwise just a raw stream of frames will be read
+        hwaccel (str): Hardware acceleration method to decode the video with (e.g. 'cuda', 'vaapi', 'videotoolbox'),
+            see `ffmpeg -hwaccels` for the list of supported methods. If None, video is decoded on CPU
+        num_frames (int): Maximal number of frames to read. ffmpeg stops decoding once this number is reached.
+            If None, the video is read till the end
+        pix_fmt (str): Pixel format of the output frames, one of 'rgb24', 'bgr24', 'gray', 'yuv420p', 'nv12'.
+            YUV formats are returned as (height*3/2, width) arrays and take half the pipe bandwidth of rgb24.
+            yuv420p frames can be converted with yuv420p_to_rgb when needed. nv12 stores U and V samples interleaved
+            in a single plane, so yuv420p_to_rgb and split_yuv420p do not support it
+        threads (int): Number of threads used by ffmpeg. If None, number of CPU cores (but not more than 8) is used.
+            When several videos are processed in parallel, a few threads per ffmpeg instance usually give better
+            overall throughput than many threads in a single instance
+        sws_flags (str): Scaling algorithm used by ffmpeg for resizing and pixel format conversion
+            (e.g. 'fast_bilinear', 'bilinear', 'bicubic', 'lanczos'). If None, ffmpeg's default (bicubic) is used
+        accurate_seek (bool): Whether to decode the frames between the preceding keyframe and start_frame to start
+            exactly from start_frame. If False, reading starts from the closest keyframe, which saves up to a GOP
+            of decoding work, but is frame-exact only for videos where every frame is a keyframe
+        frame_sync (str): How ffmpeg matches output frames to their timestamps: 'passthrough' (every decoded frame
+            is returned once), 'cfr' (frames are duplicated or dropped to keep constant framerate), 'vfr' (frames
+            with duplicate timestamps are dropped) or 'drop' (timestamps are ignored).
+            If None, 'passthrough' is used unless respect_original_timestamps is True
 
     Returns:
         np.ndarray: (if return_attributes == False) Frames of the video
@@ -36,48 +163,94 @@ def videoread(path: Union[str, Path], return_attributes: bool = False, stream_nu
     """
     path = str(path)
     assert start_frame >= 0, "Starting frame should be positive"
+    assert num_frames is None or num_frames >= 0, "Number of frames should be positive"
+    assert frame_sync is None or frame_sync in FRAME_SYNC_MODES, \
+        "Frame sync mode '{}' is not supported, supported modes are {}".format(frame_sync, list(FRAME_SYNC_MODES))
     if not os.path.isfile(path):
         raise FileNotFoundError("{} does not exist".format(path))
 
+    if hwaccel is not None:
+        ensure_hwaccel_presence(hwaccel)
+
     video_params = read_video_params(path, stream_number=stream_number)
     resolution = np.array((video_params['width'], video_params['height']))
+    input_params = dict(loglevel='quiet')
     if start_frame != 0:
-        if output_fps is None:
-            start_frame_time = (start_frame - 0.5) / video_params['fps']
-        else:
-            start_frame_time = (start_frame - 0.5) / output_fps
-        ffmpeg_input = ffmpeg.input(path, loglevel='quiet', ss=start_frame_time)
-    else:
-        ffmpeg_input = ffmpeg.input(path, loglevel='quiet')
+        input_params['ss'] = get_seek_time(start_frame, video_params, output_fps)
+        if not accurate_seek:
+            input_params['noaccurate_seek'] = None
+    if hwaccel is not None:
+        input_params['hwaccel'] = hwaccel
+    threads = threads if threads is not None else get_default_threads()
+    input_params['threads'] = threads
+    ffmpeg_input = ffmpeg.input(path, **input_params)
     if output_resolution is not None:
         resolution = output_resolution
-        ffmpeg_input = ffmpeg_input.filter("scale", *resolution)
+        if sws_flags is not None:
+            ffmpeg_input = ffmpeg_input.filter("scale", *resolution, flags=sws_flags)
+        else:
+            ffmpeg_input = ffmpeg_input.filter("scale", *resolution)
     if output_fps is not None:
         ffmpeg_input = ffmpeg_input.filter("fps", output_fps)
         respect_original_timestamps = True
-    images = []
-    if respect_original_timestamps:
-        ffmpeg_output = ffmpeg_input.output('pipe:', format='rawvideo', pix_fmt='rgb24')
+    frame_shape = _get_frame_shape(resolution, pix_fmt)
+    frame_size = int(np.prod(frame_shape))
+    # Decode straight into a preallocated array when the number of frames is known in advance
+    if output_fps is None and 'length' in video_params:
+        frames_expected = max(video_params['length'] - start_frame, 0)
+        if num_frames is not None:
+            frames_expected = min(frames_expected, num_frames)
+    elif num_frames is not None:
+        frames_expected = num_frames
     else:
-        ffmpeg_output = ffmpeg_input.output('pipe:', format='rawvideo', pix_fmt='rgb24', vsync='0')
-    ffmpeg_process = ffmpeg_output.global_args('-nostdin').run_async(pipe_stdout=True)
+        frames_expected = 0
+    images = np.empty((frames_expected, *frame_shape), dtype=np.uint8)
+    output_params = dict(format='rawvideo', pix_fmt=pix_fmt)
+    if frame_sync is not None:
+        output_params['vsync'] = FRAME_SYNC_MODES[frame_sync]
+    elif not respect_original_timestamps:
+        output_params['vsync'] = FRAME_SYNC_MODES['passthrough']
+    if num_frames is not None:
+        output_params['vframes'] = num_frames
+    if sws_flags is not None:
+        output_params['sws_flags'] = sws_flags
+    ffmpeg_output = ffmpeg_input.output('pipe:', **output_params).global_args('-nostdin')
+    if (output_resolution is not None or output_fps is not None) and is_option_supported('filter_complex_threads'):
+        # Filters are passed to ffmpeg as a filter graph, which is processed in a single thread by default.
+        # Option is available since ffmpeg 4.0
+        ffmpeg_output = ffmpeg_output.global_args('-filter_complex_threads', str(threads))
+    if start_frame == 0 and num_frames is None:
+        # Whole file is going to be read
+        prefetch_file(path)
+    ffmpeg_process = run_async(ffmpeg_output, pipe_stdout=True, buffered=False)
     try:
-        while True:
-            in_bytes = ffmpeg_process.stdout.read(np.prod(resolution) * 3)
-            if not in_bytes:
+        # Read all expected frames at once, without a per-frame Python loop
+        frames_read = readinto_exact(ffmpeg_process.stdout, images) // frame_size
+        next_frame = None
+        while frames_read == len(images) and (num_frames is None or frames_read < num_frames):
+            # Buffer is full, check that the stream has more frames before growing it,
+            # so fully read videos of known length are not reallocated
+            if next_frame is None:
+                next_frame = np.empty(frame_shape, dtype=np.uint8)
+            if readinto_exact(ffmpeg_process.stdout, next_frame) < frame_size:
                 break
-            in_frame = np.frombuffer(in_bytes, np.uint8).reshape(*resolution[::-1], 3)
-            images.append(in_frame)
+            # Length is unknown or the stream is longer than expected, grow the buffer geometrically
+            images.resize((max(2 * len(images), MIN_READ_BUFFER_FRAMES), *frame_shape), refcheck=False)
+            images[frames_read] = next_frame
+            frames_read += 1
+            frames_read += readinto_exact(ffmpeg_process.stdout, images[frames_read:]) // frame_size
     finally:
         ffmpeg_process.stdout.close()
         ffmpeg_process.wait()
-    images = np.stack(images, axis=0)
+    if frames_read < len(images):
+        images.resize((frames_read, *frame_shape), refcheck=False)
     if return_attributes:
         return images, video_params
     return images
 
 
-def videosave(path: Union[str, Path], images: np.ndarray, lossless: bool = False, preset: str = 'slow', fps: float = None):
+def videosave(path: Union[str, Path], images: np.ndarray, lossless: bool = False, preset: str = 'slow', fps: float = None,
+        threads: Optional[int] = None, hwaccel: Optional[str] = None):
     """
     Saves the video with encoded with H.264 codec
     Args:
@@ -87,35 +260,23 @@ def videosave(path: Union[str, Path], images: np.ndarray, lossless: bool = False
             Be aware: lossless format is still lossy due to RGB to YUV conversion inaccuracy
         preset (str): H.264 compression preset
         fps (float): Target FPS. If None, will be set to ffmpeg's default
+        threads (int): Number of threads used by ffmpeg. If None, number of CPU cores (but not more than 8) is used.
+            When several videos are processed in parallel, a few threads per ffmpeg instance usually give better
+            overall throughput than many threads in a single instance
+        hwaccel (str): Hardware H.264 encoder to use instead of libx264 – 'nvenc' (NVIDIA), 'qsv' (Intel Quick Sync)
+            or 'vaapi'. Preset is mapped to the closest preset of the encoder. If None, libx264 is used.
+            VA-API device is taken from VIDEOIO_VAAPI_DEVICE environment variable (/dev/dri/renderD128 by default)
     """
-    ensure_encoder_presence()
     path = str(path)
     assert images[0].shape[2] == 3, "Alpha channel is not supported"
-    assert preset in H264_PRESETS, "Preset '{}' is not supported by libx264, supported presets are {}". \
-        format(preset, H264_PRESETS)
     resolution = images[0].shape[:2][::-1]
-    input_params = dict(format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(*resolution), loglevel='quiet')
-    if fps is not None:
-        input_params['framerate'] = fps
-    ffmpeg_input = ffmpeg.input('pipe:', **input_params)
-    encoding_params = {"c:v": "libx264", "preset": preset}
-    if lossless:
-        encoding_params['profile:v'] = 'high444'
-        encoding_params['crf'] = 0
-
-    ffmpeg_process = ffmpeg_input.output(path, pix_fmt='yuv444p' if lossless else 'yuv420p', **encoding_params)
-
-    ffmpeg_process = ffmpeg_process.overwrite_output().run_async(pipe_stdin=True)
-    try:
-        for color_frame in images:
-            if color_frame.dtype == np.float16 or color_frame.dtype == np.float32 or color_frame.dtype == np.float64:
-                color_frame = (color_frame * 255).astype(np.uint8)
-            elif color_frame.dtype != np.uint8:
-                raise NotImplementedError("Dtype {} is not supported".format(color_frame.dtype))
-            ffmpeg_process.stdin.write(color_frame.tobytes())
-    finally:
-        ffmpeg_process.stdin.close()
-        ffmpeg_process.wait()
+    with VideoWriter(path, resolution, lossless=lossless, preset=preset, fps=fps, threads=threads,
+            hwaccel=hwaccel) as writer:
+        if isinstance(images, np.ndarray):
+            writer.write_batch(images)
+        else:
+            for color_frame in images:
+                writer.write(color_frame)
 
 
 class VideoReader:
@@ -125,7 +286,10 @@ class VideoReader:
 
     def __init__(self, path: Union[str, Path], stream_number: int = 0,
             output_resolution: Tuple[int, int] = None, output_fps: float = None, start_frame: int = 0,
-            respect_original_timestamps: bool = False):
+            respect_original_timestamps: bool = False, hwaccel: Optional[str] = None, num_frames: Optional[int] = None,
+            prefetch: int = 0, reuse_buffer: bool = False, pix_fmt: str = 'rgb24', threads: Optional[int] = None,
+            sws_flags: Optional[str] = None, accurate_seek: bool = True, backend: str = 'ffmpeg',
+            count_frames: bool = False, frame_sync: Optional[str] = None):
         """
         Args:
             path (str, Path): Path to input video
@@ -140,17 +304,71 @@ class VideoReader:
             respect_original_timestamps (bool): whether to read frames according to timestamps or not
                 If True, frames will be extracted according to framerate and video timestamps,
                 otherwise just a raw stream of frames will be read
+            hwaccel (str): Hardware acceleration method to decode the video with (e.g. 'cuda', 'vaapi', 'videotoolbox'),
+                see `ffmpeg -hwaccels` for the list of supported methods. If None, video is decoded on CPU
+            num_frames (int): Maximal number of frames to read. ffmpeg stops decoding once this number is reached.
+                If None, the video is read till the end
+            prefetch (int): Number of frames to read ahead in a background thread.
+                Overlaps ffmpeg decoding with the processing of the previous frames. If 0, frames are read on demand
+            reuse_buffer (bool): Whether to return every frame in the same array instead of allocating a new one.
+                If True, returned frame is overwritten after the next call, copy it if it needs to be kept.
+                With prefetch > 0, frames are read into a fixed pool of prefetch + 2 buffers
+            pix_fmt (str): Pixel format of the output frames, one of 'rgb24', 'bgr24', 'gray', 'yuv420p', 'nv12'.
+                YUV formats are returned as (height*3/2, width) arrays and take half the pipe bandwidth of rgb24.
+                yuv420p frames can be converted with yuv420p_to_rgb when needed. nv12 stores U and V samples interleaved
+                in a single plane, so yuv420p_to_rgb and split_yuv420p do not support it
+            threads (int): Number of threads used by ffmpeg. If None, number of CPU cores (but not more than 8) is used.
+                When several videos are processed in parallel, a few threads per ffmpeg instance usually give better
+                overall throughput than many threads in a single instance
+            sws_flags (str): Scaling algorithm used by ffmpeg for resizing and pixel format conversion
+                (e.g. 'fast_bilinear', 'bilinear', 'bicubic', 'lanczos'). If None, ffmpeg's default (bicubic) is used
+            accurate_seek (bool): Whether to decode the frames between the preceding keyframe and start_frame to start
+                exactly from start_frame. If False, reading starts from the closest keyframe, which saves up to a GOP
+                of decoding work, but is frame-exact only for videos where every frame is a keyframe
+            backend (str): 'ffmpeg' to decode in an ffmpeg subprocess or 'pyav' to decode in-process with PyAV.
+                PyAV saves the process startup and the copy of every frame through the pipe; rgb24, bgr24 and gray
+                frames are returned as (possibly non-contiguous) views of the decoded frames.
+                hwaccel, output_fps, respect_original_timestamps, prefetch, sws_flags and frame_sync modes other than
+                'passthrough' are not supported by PyAV
+            count_frames (bool): Whether to count the frames of the video in advance for the exact len().
+                Requires decoding the whole video once with ffprobe. If False, len() relies on the frame count stored
+                in the container, which might be missing or inaccurate
+            frame_sync (str): How ffmpeg matches output frames to their timestamps: 'passthrough' (every decoded
+                frame is returned once), 'cfr' (frames are duplicated or dropped to keep constant framerate), 'vfr'
+                (frames with duplicate timestamps are dropped) or 'drop' (timestamps are ignored).
+                If None, 'passthrough' is used unless respect_original_timestamps is True
         """
         path = str(path)
         assert start_frame >= 0, "Starting frame should be positive"
+        assert num_frames is None or num_frames >= 0, "Number of frames should be positive"
+        assert prefetch >= 0, "Number of prefetched frames should be positive"
+        assert backend in BACKENDS, "Backend '{}' is not supported, supported backends are {}".format(backend, BACKENDS)
+        assert frame_sync is None or frame_sync in FRAME_SYNC_MODES, \
+            "Frame sync mode '{}' is not supported, supported modes are {}".format(frame_sync, list(FRAME_SYNC_MODES))
+        if backend == 'pyav' and (hwaccel is not None or output_fps is not None or respect_original_timestamps or
+                                  prefetch > 0 or sws_flags is not None or frame_sync not in (None, 'passthrough')):
+            raise NotImplementedError("hwaccel, output_fps, respect_original_timestamps, prefetch, sws_flags "
+                                      "and frame_sync modes other than passthrough are not supported by PyAV backend")
         self.path = path
         self.start_frame = start_frame
+        self.num_frames = num_frames
+        self.prefetch = prefetch
+        self.pix_fmt = pix_fmt
+        self.threads = threads if threads is not None else get_default_threads()
+        self.sws_flags = sws_flags
+        self.accurate_seek = accurate_seek
+        self.backend = backend
+        self.stream_number = stream_number
         self.respect_original_timestamps = respect_original_timestamps
+        self.frame_sync = frame_sync
         self.output_fps = output_fps
+        self.hwaccel = hwaccel
         if not os.path.isfile(path):
             raise FileNotFoundError("{} does not exist".format(path))
+        if hwaccel is not None:
+            ensure_hwaccel_presence(hwaccel)
 
-        self.video_params = read_video_params(path, stream_number=stream_number)
+        self.video_params = read_video_params(path, stream_number=stream_number, count_frames=count_frames)
         self._resolution = np.array((self.video_params['width'], self.video_params['height']))
         if output_resolution is not None:
             self._resolution = output_resolution
@@ -159,33 +377,97 @@ class VideoReader:
             self.apply_scale = False
         if self.output_fps is not None:
             self.respect_original_timestamps = True
+        self._frame_shape = _get_frame_shape(self._resolution, pix_fmt)
+        self._frame_size = int(np.prod(self._frame_shape))
         self.ffmpeg_process = None
+        self._prefetcher = None
+        self.reuse_buffer = reuse_buffer
+        self._frame_buffer = np.empty(self._frame_shape, dtype=np.uint8) if reuse_buffer and prefetch == 0 else None
+        # Prefetched frame handed out by the last __next__ call, returned to the buffer pool on the next call
+        self._held_frame = None
+        self._pyav_reader = None
+        self._frames_left = None
+        # ffmpeg command line, compiled on the first iteration and reused while the reader parameters are unchanged
+        self._cmd = None
+        self._cmd_key = None
 
-    def __iter__(self):
+    def _get_cmd_key(self) -> tuple:
+        """
+        Reader parameters the ffmpeg command line depends on
+        """
+        return (self.path, self.start_frame, self.num_frames, self.pix_fmt, self.threads, self.sws_flags,
+                self.accurate_seek, self.hwaccel, tuple(int(x) for x in self._resolution), self.apply_scale,
+                self.output_fps, self.frame_sync, self.respect_original_timestamps)
+
+    def _build_cmd(self) -> List[str]:
+        """
+        Build ffmpeg command line for decoding the video with the reader parameters
+        Returns:
+            List[str]: ffmpeg arguments
+        """
+        input_params = dict(loglevel='quiet')
         if self.start_frame != 0:
-            if self.output_fps is None:
-                start_frame_time = (self.start_frame - 0.5) / self.video_params['fps']
-            else:
-                start_frame_time = (self.start_frame - 0.5) / self.output_fps
-            ffmpeg_input = ffmpeg.input(self.path, loglevel='quiet', ss=start_frame_time)
-        else:
-            ffmpeg_input = ffmpeg.input(self.path, loglevel='quiet')
+            input_params['ss'] = get_seek_time(self.start_frame, self.video_params, self.output_fps)
+            if not self.accurate_seek:
+                input_params['noaccurate_seek'] = None
+        if self.hwaccel is not None:
+            input_params['hwaccel'] = self.hwaccel
+        input_params['threads'] = self.threads
+        ffmpeg_input = ffmpeg.input(self.path, **input_params)
         if self.apply_scale:
-            ffmpeg_input = ffmpeg_input.filter("scale", *self._resolution)
+            if self.sws_flags is not None:
+                ffmpeg_input = ffmpeg_input.filter("scale", *self._resolution, flags=self.sws_flags)
+            else:
+                ffmpeg_input = ffmpeg_input.filter("scale", *self._resolution)
         if self.output_fps is not None:
             ffmpeg_input = ffmpeg_input.filter("fps", self.output_fps)
-        if self.respect_original_timestamps:
-            ffmpeg_output = ffmpeg_input.output('pipe:', format='rawvideo', pix_fmt='rgb24')
-        else:
-            ffmpeg_output = ffmpeg_input.output('pipe:', format='rawvideo', pix_fmt='rgb24', vsync='0')
-        self.ffmpeg_process = ffmpeg_output.global_args('-nostdin').run_async(pipe_stdout=True)
+        output_params = dict(format='rawvideo', pix_fmt=self.pix_fmt)
+        if self.frame_sync is not None:
+            output_params['vsync'] = FRAME_SYNC_MODES[self.frame_sync]
+        elif not self.respect_original_timestamps:
+            output_params['vsync'] = FRAME_SYNC_MODES['passthrough']
+        if self.num_frames is not None:
+            output_params['vframes'] = self.num_frames
+        if self.sws_flags is not None:
+            output_params['sws_flags'] = self.sws_flags
+        ffmpeg_output = ffmpeg_input.output('pipe:', **output_params).global_args('-nostdin')
+        if (self.apply_scale or self.output_fps is not None) and is_option_supported('filter_complex_threads'):
+            # Filters are passed to ffmpeg as a filter graph, which is processed in a single thread by default.
+            # Option is available since ffmpeg 4.0
+            ffmpeg_output = ffmpeg_output.global_args('-filter_complex_threads', str(self.threads))
+        return ffmpeg_output.compile()
+
+    def __iter__(self):
+        # Reader, process and prefetching thread of the previous pass are released before starting a new one
+        self.close()
+        if self.backend == 'pyav':
+            start_time = get_seek_time(self.start_frame, self.video_params) if self.start_frame != 0 else None
+            self._pyav_reader = PyAVReader(self.path, self.stream_number, self._frame_shape, self._resolution,
+                self.pix_fmt, start_time=start_time, accurate_seek=self.accurate_seek, threads=self.threads)
+            self._frames_left = self.num_frames
+            return self
+        cmd_key = self._get_cmd_key()
+        if self._cmd is None or cmd_key != self._cmd_key:
+            self._cmd = self._build_cmd()
+            self._cmd_key = cmd_key
+        self.ffmpeg_process = run_async(self._cmd, pipe_stdout=True, buffered=False)
+        if self.prefetch > 0:
+            self._prefetcher = FramePrefetcher(self.ffmpeg_process.stdout, self._frame_shape, depth=self.prefetch,
+                reuse_buffers=self.reuse_buffer)
+            self._held_frame = None
         return self
 
     def __len__(self) -> int:
-        if 'length' in self.video_params:
-            return max(self.video_params['length'] - self.start_frame, 0)
-        else:
+        length = self.video_params.get('exact_length', self.video_params.get('length'))
+        if length is None:
             return 0
+        if self.output_fps is not None and self.video_params['fps']:
+            # Frames are resampled to output_fps, so the number of frames changes proportionally to the framerate
+            length = int(round(length * self.output_fps / self.video_params['fps']))
+        length = max(length - self.start_frame, 0)
+        if self.num_frames is not None:
+            length = min(length, self.num_frames)
+        return length
 
     @property
     def resolution(self) -> Tuple[int, int]:
@@ -215,15 +497,111 @@ class VideoReader:
         """
         Close reader thread
         """
-        if hasattr(self, "ffmpeg_process") and self.ffmpeg_process is not None:
-            self.ffmpeg_process.stdout.close()
-            self.ffmpeg_process.wait()
+        if getattr(self, "_pyav_reader", None) is not None:
+            self._pyav_reader.close()
+            self._pyav_reader = None
+        # Process and thread are detached first, so repeated calls (e.g. close() followed by __del__) are no-op
+        ffmpeg_process, self.ffmpeg_process = getattr(self, "ffmpeg_process", None), None
+        prefetcher, self._prefetcher = getattr(self, "_prefetcher", None), None
+        self._held_frame = None
+        try:
+            if ffmpeg_process is not None:
+                # Pipe is closed before stopping the prefetching thread, so a pending read returns
+                # and ffmpeg is not left blocked on a full pipe
+                ffmpeg_process.stdout.close()
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            if ffmpeg_process is not None:
+                ffmpeg_process.wait()
+
+    def _read_pyav_frame(self) -> Optional[np.ndarray]:
+        if self._frames_left is not None:
+            if self._frames_left == 0:
+                return None
+            self._frames_left -= 1
+        return self._pyav_reader.read()
+
+    def read_into(self, out: np.ndarray) -> bool:
+        """
+        Read next frame directly into a caller-provided array, avoiding per-frame allocations
+        Args:
+            out (np.ndarray): C-contiguous uint8 array with the shape of the output frame
+                ((height, width, 3) for RGB frames)
+        Returns:
+            bool: True if the frame was read, False if the end of the video is reached
+        """
+        assert out.dtype == np.uint8 and out.flags['C_CONTIGUOUS'], "Output array should be C-contiguous uint8 array"
+        assert out.shape == self._frame_shape, \
+            "Output array shape does not match with video resolution – expected {}, got {}". \
+                format(self._frame_shape, out.shape)
+        if self._prefetcher is not None:
+            in_frame = self._prefetcher.get()
+            if in_frame is None:
+                return False
+            np.copyto(out, in_frame)
+            self._prefetcher.release(in_frame)
+            return True
+        if self._pyav_reader is not None:
+            in_frame = self._read_pyav_frame()
+            if in_frame is None:
+                return False
+            np.copyto(out, in_frame)
+            return True
+        return readinto_exact(self.ffmpeg_process.stdout, out) == self._frame_size
+
+    def skip(self, n: int) -> int:
+        """
+        Skip next n frames without converting them to arrays.
+        Frames are still decoded by ffmpeg, use output_fps to reduce the amount of decoded frames instead
+        Args:
+            n (int): Number of frames to skip
+        Returns:
+            int: number of skipped frames, less than n only if the end of the video is reached
+        """
+        if self._prefetcher is not None:
+            for frame_ind in range(n):
+                in_frame = self._prefetcher.get()
+                if in_frame is None:
+                    return frame_ind
+                self._prefetcher.release(in_frame)
+            return n
+        if self._pyav_reader is not None:
+            for frame_ind in range(n):
+                if self._read_pyav_frame() is None:
+                    return frame_ind
+            return n
+        discard_buffer = bytearray(self._frame_size)
+        for frame_ind in range(n):
+            if readinto_exact(self.ffmpeg_process.stdout, discard_buffer) < self._frame_size:
+                return frame_ind
+        return n
 
     def __next__(self) -> np.ndarray:
-        in_bytes = self.ffmpeg_process.stdout.read(np.prod(self._resolution) * 3)
-        if not in_bytes:
+        if self._prefetcher is not None:
+            if self._held_frame is not None:
+                self._prefetcher.release(self._held_frame)
+                self._held_frame = None
+            in_frame = self._prefetcher.get()
+            if in_frame is None:
+                raise StopIteration
+            if self.reuse_buffer:
+                self._held_frame = in_frame
+            return in_frame
+        if self._pyav_reader is not None:
+            in_frame = self._read_pyav_frame()
+            if in_frame is None:
+                raise StopIteration
+            if self._frame_buffer is not None:
+                np.copyto(self._frame_buffer, in_frame)
+                return self._frame_buffer
+            return in_frame
+        if self._frame_buffer is not None:
+            in_frame = self._frame_buffer
+        else:
+            in_frame = np.empty(self._frame_shape, dtype=np.uint8)
+        if readinto_exact(self.ffmpeg_process.stdout, in_frame) < self._frame_size:
             raise StopIteration
-        in_frame = np.frombuffer(in_bytes, np.uint8).reshape(*self._resolution[::-1], 3)
         return in_frame
 
     def __del__(self):
@@ -236,7 +614,8 @@ class VideoWriter:
     """
 
     def __init__(self, path: Union[str, Path], resolution: Tuple[int, int], lossless: bool = False,
-            preset: str = 'slow', fps: float = None):
+            preset: str = 'slow', fps: float = None, threads: Optional[int] = None, hwaccel: Optional[str] = None,
+            backend: str = 'ffmpeg', segment_length: Optional[int] = None):
         """
         Args:
             path (str, Path): Path to output video
@@ -245,24 +624,50 @@ class VideoWriter:
                 Be aware: lossless format is still lossy due to RGB to YUV conversion inaccuracy
             preset (str): H.264 compression preset
             fps (float): Target FPS. If None, will be set to ffmpeg's default
+            threads (int): Number of threads used by ffmpeg. If None, number of CPU cores (but not more than 8) is used.
+                When several videos are processed in parallel, a few threads per ffmpeg instance usually give better
+                overall throughput than many threads in a single instance
+            hwaccel (str): Hardware H.264 encoder to use instead of libx264 – 'nvenc' (NVIDIA),
+                'qsv' (Intel Quick Sync) or 'vaapi'. Preset is mapped to the closest preset of the encoder. If None, libx264 is used.
+                VA-API device is taken from VIDEOIO_VAAPI_DEVICE environment variable (/dev/dri/renderD128 by default)
+            backend (str): 'ffmpeg' to encode in an ffmpeg subprocess or 'pyav' to encode in-process with PyAV.
+                hwaccel and segment_length are not supported by PyAV
+            segment_length (int): If set, the video is split into separate files of segment_length frames each,
+                all encoded by the same ffmpeg process. Saves the encoder initialization when many short clips are
+                written. The path should contain a printf-style pattern for the segment number, e.g. 'out_%03d.mp4'
         """
-        ensure_encoder_presence()
         path = str(path)
-        assert preset in H264_PRESETS, "Preset '{}' is not supported by libx264, supported presets are {}". \
-            format(preset, H264_PRESETS)
+        assert backend in BACKENDS, "Backend '{}' is not supported, supported backends are {}".format(backend, BACKENDS)
         self.resolution = resolution
-        input_params = dict(format='rawvideo', pix_fmt='rgb24', s='{}x{}'.format(*resolution), loglevel='quiet')
-        if fps is not None:
-            input_params['framerate'] = fps
-        ffmpeg_input = ffmpeg.input('pipe:', **input_params)
-        encoding_params = {"c:v": "libx264", "preset": preset}
-        if lossless:
-            encoding_params['profile:v'] = 'high444'
-            encoding_params['crf'] = 0
-
-        ffmpeg_process = ffmpeg_input.output(path, pix_fmt='yuv444p' if lossless else 'yuv420p', **encoding_params)
+        self.ffmpeg_process = None
+        self._pyav_writer = None
+        if backend == 'pyav':
+            if hwaccel is not None or segment_length is not None:
+                raise NotImplementedError("hwaccel and segment_length are not supported by PyAV backend")
+            assert preset in H264_PRESETS_SET, "Preset '{}' is not supported by libx264, supported presets are {}". \
+                format(preset, H264_PRESETS)
+            self._pyav_writer = PyAVWriter(path, resolution, lossless, preset, fps,
+                threads if threads is not None else get_default_threads())
+        else:
+            input_params = {**RAW_INPUT_PARAMS, 's': '{}x{}'.format(*resolution)}
+            if fps is not None:
+                input_params['framerate'] = fps
+            output_params = None
+            if segment_length is not None:
+                assert segment_length > 0, "Segment length should be positive"
+                assert '%' in path, "Path should contain a pattern for the segment number, e.g. 'out_%03d.mp4'"
+                segment_fps = fps if fps is not None else 25
+                # Keyframes are forced at segment boundaries, so each segment contains exactly segment_length frames
+                output_params = dict(format='segment', segment_time=segment_length / segment_fps,
+                    segment_time_delta=0.5 / segment_fps, reset_timestamps=1,
+                    force_key_frames='expr:gte(n,n_forced*{})'.format(segment_length))
+            ffmpeg_process = _encoder_output(input_params, path, lossless, preset, threads, hwaccel, output_params)
 
-        self.ffmpeg_process = ffmpeg_process.overwrite_output().run_async(pipe_stdin=True)
+            self.ffmpeg_process = run_async(ffmpeg_process.overwrite_output(), pipe_stdin=True, buffered=False)
+        # Conversion buffers for float frames, allocated when the first float frame arrives
+        self._scratch_f32 = None
+        self._scratch_u8 = None
+        self._frame_shape = (int(resolution[1]), int(resolution[0]), 3)
 
     def write(self, color_frame: np.ndarray):
         """
@@ -271,22 +676,63 @@ class VideoWriter:
             color_frame (np.ndarray): RGB frame to write
         """
         assert color_frame.shape[2] == 3, "Alpha channel is not supported"
-        assert all([self.resolution[i] == color_frame.shape[1 - i] for i in range(2)]), \
+        assert color_frame.shape[:2] == self._frame_shape[:2], \
             "Resolution of color frame does not match with video _resolution – expected {}, got {}". \
                 format(self.resolution, color_frame.shape[:2][::-1])
         if color_frame.dtype == np.float16 or color_frame.dtype == np.float32 or color_frame.dtype == np.float64:
-            color_frame = (color_frame * 255).astype(np.uint8)
+            if self._scratch_f32 is None:
+                self._scratch_f32 = np.empty(color_frame.shape, dtype=np.float32)
+                self._scratch_u8 = np.empty(color_frame.shape, dtype=np.uint8)
+            color_frame = _float_to_uint8(color_frame, self._scratch_f32, self._scratch_u8)
         elif color_frame.dtype != np.uint8:
             raise NotImplementedError("Dtype {} is not supported".format(color_frame.dtype))
-        self.ffmpeg_process.stdin.write(color_frame.tobytes())
+        if self._pyav_writer is not None:
+            self._pyav_writer.write(color_frame)
+        else:
+            write_buffers(self.ffmpeg_process.stdin, [np.ascontiguousarray(color_frame)])
+
+    def write_batch(self, frames: np.ndarray):
+        """
+        Write several frames at once.
+        C-contiguous uint8 frames are passed to ffmpeg in a single write call, float frames are converted in chunks
+        Args:
+            frames (np.ndarray): RGB frames to write, array of shape (number of frames, height, width, 3)
+        """
+        assert frames.ndim == 4 and frames.shape[1:] == self._frame_shape, \
+            "Shape of frames does not match with video resolution – expected (N, {}, {}, {}), got {}". \
+                format(*self._frame_shape, frames.shape)
+        if self._pyav_writer is not None:
+            for color_frame in frames:
+                self.write(color_frame)
+        elif frames.dtype == np.uint8 and frames.flags['C_CONTIGUOUS']:
+            write_buffers(self.ffmpeg_process.stdin, [frames])
+        elif frames.dtype == np.float16 or frames.dtype == np.float32 or frames.dtype == np.float64:
+            # Frames are converted in chunks to bound the memory taken by conversion buffers
+            chunk_length = max(1, FLOAT_CONVERSION_CHUNK_SIZE // int(np.prod(frames.shape[1:])))
+            scratch_f32 = np.empty((min(chunk_length, len(frames)), *frames.shape[1:]), dtype=np.float32)
+            scratch_u8 = np.empty(scratch_f32.shape, dtype=np.uint8)
+            for chunk_start in range(0, len(frames), chunk_length):
+                chunk = frames[chunk_start:chunk_start + chunk_length]
+                chunk = _float_to_uint8(chunk, scratch_f32[:len(chunk)], scratch_u8[:len(chunk)])
+                write_buffers(self.ffmpeg_process.stdin, [chunk])
+        else:
+            for color_frame in frames:
+                self.write(color_frame)
 
     def close(self):
         """
         Finish video creation process and close video file
         """
-        if hasattr(self, "ffmpeg_process"):
-            self.ffmpeg_process.stdin.close()
-            self.ffmpeg_process.wait()
+        if getattr(self, "_pyav_writer", None) is not None:
+            self._pyav_writer.close()
+            self._pyav_writer = None
+        if getattr(self, "ffmpeg_process", None) is not None:
+            # Process is detached first, so repeated calls (e.g. __exit__ followed by __del__) are no-op
+            ffmpeg_process, self.ffmpeg_process = self.ffmpeg_process, None
+            try:
+                ffmpeg_process.stdin.close()
+            finally:
+                ffmpeg_process.wait()
 
     def __enter__(self):
         return self
@@ -3,7 +3,60 @@ import numpy as np
 import ffmpeg
 from pathlib import Path
 from typing import Tuple, Union
-from .info import read_video_params, H264_PRESETS, ensure_encoder_presence
+from .info import read_video_params, get_seek_time, H264_PRESETS, H264_PRESETS_SET, ensure_encoder_presence
+from .pipes import run_async, readinto_exact, write_buffers, FramePrefetcher
+
+RAW_INPUT_PARAMS = dict(format='rawvideo', pix_fmt='yuv444p', loglevel='quiet')
+# Initial buffer size of uint16read for videos with unknown number of frames
+MIN_READ_BUFFER_FRAMES = 16
+# Number of values encoded at once in uint16save
+ENCODING_CHUNK_SIZE = 1 << 24
+
+
+def _decode_frame(in_frame: np.ndarray, out: np.ndarray = None, flip_mask: np.ndarray = None) -> np.ndarray:
+    """
+    Restore uint16 frame from the planes of raw yuv444p frame produced by _encode_frame.
+    Lower byte plane of the raw frame is decoded in place
+    Args:
+        in_frame (np.ndarray): uint8 array of shape (3, height, width)
+        out (np.ndarray): Optional uint16 array of shape (height, width) to store the result in
+        flip_mask (np.ndarray): Optional uint8 scratch array of shape (height, width)
+    Returns:
+        np.ndarray: uint16 frame of shape (height, width)
+    """
+    upper_part = in_frame[2]
+    lower_coding = in_frame[0]
+    if flip_mask is None:
+        flip_mask = np.empty(upper_part.shape, dtype=np.uint8)
+    # Branchless XOR: equivalent to "if upper odd, invert lower", since 255 - x == x ^ 255 for uint8
+    np.bitwise_and(upper_part, 1, out=flip_mask)
+    np.multiply(flip_mask, 255, out=flip_mask)
+    np.bitwise_xor(lower_coding, flip_mask, out=lower_coding)
+    if out is None:
+        out = np.empty(upper_part.shape, dtype=np.uint16)
+    np.left_shift(upper_part, 8, out=out, dtype=np.uint16)
+    np.bitwise_or(out, lower_coding, out=out)
+    return out
+
+
+def _encode_frame(data: np.ndarray, out_lower: np.ndarray, out_upper: np.ndarray, flip_mask: np.ndarray):
+    """
+    Split uint16 data into the lower and upper byte planes stored in the video.
+    Works with single frames as well as with stacks of frames
+    Args:
+        data (np.ndarray): uint16 array
+        out_lower (np.ndarray): uint8 array of the same shape to store the coded lower bytes in
+        out_upper (np.ndarray): uint8 array of the same shape to store the upper bytes in
+        flip_mask (np.ndarray): uint8 scratch array of the same shape
+    """
+    np.right_shift(data, 8, out=out_upper, casting='unsafe')
+    # Cast to uint8 keeps the lower byte
+    np.copyto(out_lower, data, casting='unsafe')
+    # Branchless XOR: equivalent to "if upper odd, invert lower", since 255 - x == x ^ 255 for uint8.
+    # Neighbouring values then differ only slightly in the lower plane, which makes it compress better
+    np.bitwise_and(out_upper, 1, out=flip_mask)
+    np.multiply(flip_mask, 255, out=flip_mask)
+    np.bitwise_xor(out_lower, flip_mask, out=out_lower)
 
 
 def uint16read(path: Union[str, Path], output_resolution: Tuple[int, int] = None, start_frame: int = 0) -> np.ndarray:
@@ -27,41 +80,36 @@ def uint16read(path: Union[str, Path], output_resolution: Tuple[int, int] = None
     video_params = read_video_params(path, stream_number=0)
     resolution = (video_params['width'], video_params['height'])
     if start_frame != 0:
-        start_frame_time = (start_frame - 0.5) / video_params['fps']
+        start_frame_time = get_seek_time(start_frame, video_params)
         ffmpeg_input = ffmpeg.input(path, loglevel='quiet', ss=start_frame_time)
     else:
         ffmpeg_input = ffmpeg.input(path, loglevel='quiet')
     if output_resolution is not None:
         resolution = output_resolution
         ffmpeg_input = ffmpeg_input.filter("scale", *resolution)
-    frames = []
-    ffmpeg_process = (
-        ffmpeg_input
-        .output('pipe:', format='rawvideo', pix_fmt='yuv444p')
-        .global_args('-nostdin')
-        .run_async(pipe_stdout=True)
-    )
+    frame_shape = (int(resolution[1]), int(resolution[0]))
+    # Frames are decoded straight into the output array, preallocated when the number of frames is known in advance
+    frames_expected = max(video_params['length'] - start_frame, 0) if 'length' in video_params else 0
+    frames = np.empty((frames_expected, *frame_shape), dtype=np.uint16)
+    ffmpeg_output = ffmpeg_input.output('pipe:', format='rawvideo', pix_fmt='yuv444p').global_args('-nostdin')
+    ffmpeg_process = run_async(ffmpeg_output, pipe_stdout=True, buffered=False)
+    # Raw frames are read straight from the pipe into a reused buffer
+    in_frame = np.empty((3, *frame_shape), dtype=np.uint8)
+    flip_mask = np.empty(frame_shape, dtype=np.uint8)
+    frames_read = 0
     try:
-        while True:
-            in_bytes = ffmpeg_process.stdout.read(np.prod(resolution) * 3)
-            if not in_bytes:
-                break
-            in_frame = (
-                np
-                .frombuffer(in_bytes, np.uint8)
-                .reshape(3, *resolution[::-1])
-            )
-            upper_part = in_frame[2, :, :]
-            lower_coding = in_frame[0, :, :]
-            upper_isodd = (upper_part & 1) == 1
-            lower_part = lower_coding.copy()
-            lower_part[upper_isodd] = 255 - lower_part[upper_isodd]
-            frame = lower_part.astype(np.uint16) + (upper_part.astype(np.uint16) << 8)
-            frames.append(frame)
+        while readinto_exact(ffmpeg_process.stdout, in_frame) == in_frame.size:
+            if frames_read == len(frames):
+                # Length is unknown or the stream is longer than expected, grow the buffer geometrically
+                frames.resize((max(2 * len(frames), MIN_READ_BUFFER_FRAMES), *frame_shape), refcheck=False)
+            _decode_frame(in_frame, out=frames[frames_read], flip_mask=flip_mask)
+            frames_read += 1
     finally:
         ffmpeg_process.stdout.close()
         ffmpeg_process.wait()
-    return np.stack(frames, axis=0)
+    if frames_read < len(frames):
+        frames.resize((frames_read, *frame_shape), refcheck=False)
+    return frames
 
 
 def uint16save(path: Union[str, Path], data: np.ndarray, preset: str = 'slow', fps: float = None):
@@ -75,43 +123,50 @@ def uint16save(path: Union[str, Path], data: np.ndarray, preset: str = 'slow', f
     """
     ensure_encoder_presence()
     path = str(path)
-    data = np.array(data)
+    data = np.asarray(data)
     assert len(data[0].shape) == 2, "Multiple dimentions is not supported"
     assert data.dtype == np.uint16 or data.dtype == np.uint8, "Dtype {} is not supported".format(data.dtype)
-    assert preset in H264_PRESETS, "Preset '{}' is not supported by libx264, supported presets are {}". \
+    assert preset in H264_PRESETS_SET, "Preset '{}' is not supported by libx264, supported presets are {}". \
         format(preset, H264_PRESETS)
     resolution = data[0].shape[::-1]
-    input_params = dict(format='rawvideo', pix_fmt='yuv444p', s='{}x{}'.format(*resolution), loglevel='quiet')
+    input_params = {**RAW_INPUT_PARAMS, 's': '{}x{}'.format(*resolution)}
     if fps is not None:
         input_params['framerate'] = fps
     ffmpeg_input = ffmpeg.input('pipe:', **input_params)
     encoding_params = {'c:v': 'libx264', 'preset': preset, 'profile:v': 'high444', 'crf': 0}
-    zeros = np.zeros(data.shape, dtype=np.uint8)
+    # Unused middle plane is the same for every frame, so only one zero plane is allocated
+    zeros = np.zeros(data.shape[1:], dtype=np.uint8)
+    # Frames are encoded in chunks to bound the memory taken by encoding buffers
+    chunk_length = max(1, ENCODING_CHUNK_SIZE // data[0].size)
     if data.dtype == np.uint16:
-        upper_part = (data >> 8).astype(np.uint8)
-        lower_part = (data & 255).astype(np.uint8)
-        upper_isodd = (upper_part & 1) == 1
-        lower_coding = lower_part.copy()
-        lower_coding[upper_isodd] = 255 - lower_coding[upper_isodd]
-        data = np.stack([lower_coding, zeros, upper_part], axis=1)
-    else:
-        data = np.stack([data, zeros, zeros], axis=1)
-    ffmpeg_process = (
-        ffmpeg_input
-        .output(path, pix_fmt='yuv444p', **encoding_params)
-        .overwrite_output()
-        .run_async(pipe_stdin=True)
-    )
+        buffers_shape = (min(chunk_length, len(data)), *data.shape[1:])
+        lower_buffer = np.empty(buffers_shape, dtype=np.uint8)
+        upper_buffer = np.empty(buffers_shape, dtype=np.uint8)
+        mask_buffer = np.empty(buffers_shape, dtype=np.uint8)
+    ffmpeg_output = ffmpeg_input.output(path, pix_fmt='yuv444p', **encoding_params).overwrite_output()
+    ffmpeg_process = run_async(ffmpeg_output, pipe_stdin=True, buffered=False)
     try:
-        for frame in data:
-            ffmpeg_process.stdin.write(frame.tobytes())
+        for chunk_start in range(0, len(data), chunk_length):
+            chunk = data[chunk_start:chunk_start + chunk_length]
+            if data.dtype == np.uint16:
+                upper_part = upper_buffer[:len(chunk)]
+                lower_coding = lower_buffer[:len(chunk)]
+                _encode_frame(chunk, lower_coding, upper_part, mask_buffer[:len(chunk)])
+            else:
+                lower_coding = np.ascontiguousarray(chunk)
+                upper_part = [zeros] * len(chunk)
+            # All frames of the chunk are sent with a single scatter-gather write
+            write_buffers(ffmpeg_process.stdin,
+                [plane for lower_frame, upper_frame in zip(lower_coding, upper_part)
+                 for plane in (lower_frame, zeros, upper_frame)])
     finally:
         ffmpeg_process.stdin.close()
         ffmpeg_process.wait()
 
 
 class Uint16Reader:
-    def __init__(self, path: Union[str, Path], output_resolution: Tuple[int, int] = None, start_frame: int = 0):
+    def __init__(self, path: Union[str, Path], output_resolution: Tuple[int, int] = None, start_frame: int = 0,
+            prefetch: int = 0):
         """
         Iterable class for reading uint16 data sequentially
         Args:
@@ -121,37 +176,50 @@ class Uint16Reader:
                 Warning: changing this parameter may lead to undesirable data corruption.
             start_frame (int): frame to start reading from.
                 Correct behaviour is guaranteed only if input array was produced by videoio.
+            prefetch (int): Number of raw frames to read ahead in a background thread.
+                Overlaps ffmpeg decoding and pipe reads with the decoding of the previous frames.
+                If 0, frames are read on demand
         """
         path = str(path)
         assert start_frame >= 0, "Starting frame should be positive"
+        assert prefetch >= 0, "Number of prefetched frames should be positive"
         self.path = path
         self.start_frame = start_frame
+        self.prefetch = prefetch
         if not os.path.isfile(path):
             raise FileNotFoundError("{} does not exist".format(path))
 
         self.video_params = read_video_params(path, stream_number=0)
-        self.resolution = np.array((self.video_params['width'], self.video_params['height']))
+        self.resolution = (self.video_params['width'], self.video_params['height'])
         if output_resolution is not None:
-            self.resolution = output_resolution
+            self.resolution = tuple(output_resolution)
             self.apply_scale = True
         else:
             self.apply_scale = False
         self.ffmpeg_process = None
+        self._prefetcher = None
+        self._frame_shape = (int(self.resolution[1]), int(self.resolution[0]))
+        self._raw_frame_shape = (3, *self._frame_shape)
+        # Raw frames are read straight from the pipe into a reused buffer
+        self._in_frame = np.empty(self._raw_frame_shape, dtype=np.uint8)
+        self._flip_mask = np.empty(self._frame_shape, dtype=np.uint8)
 
     def __iter__(self):
+        # Process and prefetching thread of the previous pass are released before starting a new one
+        self.close()
         if self.start_frame != 0:
-            start_frame_time = (self.start_frame - 0.5) / self.video_params['fps']
+            start_frame_time = get_seek_time(self.start_frame, self.video_params)
             ffmpeg_input = ffmpeg.input(self.path, loglevel='quiet', ss=start_frame_time)
         else:
             ffmpeg_input = ffmpeg.input(self.path, loglevel='quiet')
         if self.apply_scale:
             ffmpeg_input = ffmpeg_input.filter("scale", *self.resolution)
-        self.ffmpeg_process = (
-            ffmpeg_input
-            .output('pipe:', format='rawvideo', pix_fmt='yuv444p')
-            .global_args('-nostdin')
-            .run_async(pipe_stdout=True)
-        )
+        ffmpeg_output = ffmpeg_input.output('pipe:', format='rawvideo', pix_fmt='yuv444p').global_args('-nostdin')
+        self.ffmpeg_process = run_async(ffmpeg_output, pipe_stdout=True, buffered=False)
+        if self.prefetch > 0:
+            # Raw frames are read into a fixed pool of buffers, each buffer is released right after decoding
+            self._prefetcher = FramePrefetcher(self.ffmpeg_process.stdout, self._raw_frame_shape,
+                depth=self.prefetch, reuse_buffers=True)
         return self
 
     def __len__(self) -> int:
@@ -164,21 +232,32 @@ class Uint16Reader:
         """
         Close reader thread
         """
-        if hasattr(self, "ffmpeg_process") and self.ffmpeg_process is not None:
-            self.ffmpeg_process.stdout.close()
-            self.ffmpeg_process.wait()
+        # Process and thread are detached first, so repeated calls (e.g. close() followed by __del__) are no-op
+        ffmpeg_process, self.ffmpeg_process = getattr(self, "ffmpeg_process", None), None
+        prefetcher, self._prefetcher = getattr(self, "_prefetcher", None), None
+        try:
+            if ffmpeg_process is not None:
+                # Pipe is closed before stopping the prefetching thread, so a pending read returns
+                # and ffmpeg is not left blocked on a full pipe
+                ffmpeg_process.stdout.close()
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            if ffmpeg_process is not None:
+                ffmpeg_process.wait()
 
     def __next__(self) -> np.ndarray:
-        in_bytes = self.ffmpeg_process.stdout.read(np.prod(self.resolution) * 3)
-        if not in_bytes:
-            raise StopIteration
-        in_frame = np.frombuffer(in_bytes, np.uint8).reshape(3, *self.resolution[::-1])
-        upper_part = in_frame[2, :, :]
-        lower_coding = in_frame[0, :, :]
-        upper_isodd = (upper_part & 1) == 1
-        lower_part = lower_coding.copy()
-        lower_part[upper_isodd] = 255 - lower_part[upper_isodd]
-        frame = lower_part.astype(np.uint16) + (upper_part.astype(np.uint16) << 8)
+        if self._prefetcher is not None:
+            in_frame = self._prefetcher.get()
+            if in_frame is None:
+                raise StopIteration
+        else:
+            in_frame = self._in_frame
+            if readinto_exact(self.ffmpeg_process.stdout, in_frame) < in_frame.size:
+                raise StopIteration
+        frame = _decode_frame(in_frame, flip_mask=self._flip_mask)
+        if self._prefetcher is not None:
+            self._prefetcher.release(in_frame)
         return frame
 
     def __del__(self):
@@ -200,19 +279,19 @@ class Uint16Writer:
         """
         ensure_encoder_presence()
         path = str(path)
-        assert preset in H264_PRESETS, "Preset '{}' is not supported by libx264, supported presets are {}". \
+        assert preset in H264_PRESETS_SET, "Preset '{}' is not supported by libx264, supported presets are {}". \
             format(preset, H264_PRESETS)
-        input_params = dict(format='rawvideo', pix_fmt='yuv444p', s='{}x{}'.format(*resolution), loglevel='quiet')
+        input_params = {**RAW_INPUT_PARAMS, 's': '{}x{}'.format(*resolution)}
         if fps is not None:
             input_params['framerate'] = fps
         ffmpeg_input = ffmpeg.input('pipe:', **input_params)
         encoding_params = {'c:v': 'libx264', 'preset': preset, 'profile:v': 'high444', 'crf': 0}
-        self.ffmpeg_process = (
-            ffmpeg_input
-            .output(path, pix_fmt='yuv444p', **encoding_params)
-            .overwrite_output()
-            .run_async(pipe_stdin=True)
-        )
+        self._frame_shape = (int(resolution[1]), int(resolution[0]))
+        ffmpeg_output = ffmpeg_input.output(path, pix_fmt='yuv444p', **encoding_params).overwrite_output()
+        self.ffmpeg_process = run_async(ffmpeg_output, pipe_stdin=True, buffered=False)
+        # Staging buffer for the encoded yuv444p frame, reused across writes. Middle plane always stays zero
+        self._encoded = np.zeros((3, *self._frame_shape), dtype=np.uint8)
+        self._flip_mask = np.empty(self._frame_shape, dtype=np.uint8)
 
     def write(self, data: np.ndarray):
         """
@@ -222,25 +301,29 @@ class Uint16Writer:
         """
         assert len(data.shape) == 2, "Multiple dimensions is not supported"
         assert data.dtype == np.uint16 or data.dtype == np.uint8, "Dtype {} is not supported".format(data.dtype)
-        zeros = np.zeros(data.shape, dtype=np.uint8)
+        assert data.shape == self._frame_shape, \
+            "Resolution of data does not match with video resolution – expected {}, got {}". \
+                format(self._frame_shape[::-1], data.shape[::-1])
+        encoded = self._encoded
         if data.dtype == np.uint16:
-            upper_part = (data >> 8).astype(np.uint8)
-            lower_part = (data & 255).astype(np.uint8)
-            upper_isodd = (upper_part & 1) == 1
-            lower_coding = lower_part.copy()
-            lower_coding[upper_isodd] = 255 - lower_coding[upper_isodd]
-            data = np.stack([lower_coding, zeros, upper_part], axis=0)
+            _encode_frame(data, encoded[0], encoded[2], self._flip_mask)
+            write_buffers(self.ffmpeg_process.stdin, [encoded])
         else:
-            data = np.stack([data, zeros, zeros], axis=0)
-        self.ffmpeg_process.stdin.write(data.tobytes())
+            # uint8 data is sent as is, followed by two planes of zeros
+            zeros = encoded[1]
+            write_buffers(self.ffmpeg_process.stdin, [np.ascontiguousarray(data), zeros, zeros])
 
     def close(self):
         """
         Finish video creation process and close video file
         """
-        if hasattr(self, "ffmpeg_process"):
-            self.ffmpeg_process.stdin.close()
-            self.ffmpeg_process.wait()
+        if getattr(self, "ffmpeg_process", None) is not None:
+            # Process is detached first, so repeated calls (e.g. __exit__ followed by __del__) are no-op
+            ffmpeg_process, self.ffmpeg_process = self.ffmpeg_process, None
+            try:
+                ffmpeg_process.stdin.close()
+            finally:
+                ffmpeg_process.wait()
 
     def __enter__(self):
         return self
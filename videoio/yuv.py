@@ -0,0 +1,65 @@
+import numpy as np
+from typing import Optional, Tuple
+
+
+def _upsample_chroma(plane: np.ndarray) -> np.ndarray:
+    return plane.repeat(2, axis=0).repeat(2, axis=1)
+
+
+def split_yuv420p(frame: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split yuv420p frame (as returned by videoread and VideoReader with pix_fmt='yuv420p') into separate planes.
+    Planes are views of the frame data, no copy is made for C-contiguous frames.
+    nv12 frames (interleaved U and V) are not supported
+    Args:
+        frame (np.ndarray): array of shape (height*3/2, width) with Y, U and V planes stored consecutively
+    Returns:
+        tuple: Tuple containing:
+            np.ndarray: Y plane of shape (height, width)
+            np.ndarray: U plane of shape (height/2, width/2)
+            np.ndarray: V plane of shape (height/2, width/2)
+    """
+    assert frame.ndim == 2 and frame.shape[0] % 3 == 0, "Frame should be array of shape (height*3/2, width)"
+    height, width = frame.shape[0] * 2 // 3, frame.shape[1]
+    planes = np.ascontiguousarray(frame).reshape(-1)
+    luma_size = height * width
+    chroma_size = (height // 2) * (width // 2)
+    luma = planes[:luma_size].reshape(height, width)
+    cb = planes[luma_size:luma_size + chroma_size].reshape(height // 2, width // 2)
+    cr = planes[luma_size + chroma_size:].reshape(height // 2, width // 2)
+    return luma, cb, cr
+
+
+def yuv420p_to_rgb(frame: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Convert yuv420p frame (as returned by videoread and VideoReader with pix_fmt='yuv420p') to RGB.
+    Uses BT.601 limited range coefficients, same as ffmpeg's default conversion.
+    nv12 frames (interleaved U and V) are not supported
+    Args:
+        frame (np.ndarray): uint8 array of shape (height*3/2, width) with Y, U and V planes stored consecutively
+        out (np.ndarray): Optional uint8 array of shape (height, width, 3) to store the result in
+    Returns:
+        np.ndarray: RGB frame of shape (height, width, 3)
+    """
+    assert frame.dtype == np.uint8 and frame.ndim == 2 and frame.shape[0] % 3 == 0, \
+        "Frame should be uint8 array of shape (height*3/2, width)"
+    height, width = frame.shape[0] * 2 // 3, frame.shape[1]
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    assert out.shape == (height, width, 3) and out.flags['C_CONTIGUOUS'], \
+        "Output array should be C-contiguous array of shape {}".format((height, width, 3))
+    luma, cb, cr = split_yuv420p(frame)
+    # Chroma contributions are computed at quarter resolution and upsampled afterwards.
+    # Rounding offset of 0.5 is added to luma, so the result can be truncated instead of rounded
+    luma = luma.astype(np.float32)
+    luma *= 1.164
+    luma += 0.5 - 16. * 1.164
+    cb = cb.astype(np.float32) - 128.
+    cr = cr.astype(np.float32) - 128.
+    rgb = np.empty((height, width, 3), dtype=np.float32)
+    np.add(luma, _upsample_chroma(1.596 * cr), out=rgb[..., 0])
+    np.subtract(luma, _upsample_chroma(0.392 * cb + 0.813 * cr), out=rgb[..., 1])
+    np.add(luma, _upsample_chroma(2.017 * cb), out=rgb[..., 2])
+    np.clip(rgb, 0, 255, out=rgb)
+    np.copyto(out, rgb, casting='unsafe')
+    return out